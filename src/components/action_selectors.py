@@ -76,29 +76,21 @@ class EpsilonGreedyAttackerActionSelector():
             probs = torch.tensor([1 / num_choices] * num_choices)
             choices = input_q_vals.max(dim=2)[1]
             random_actions = Categorical(probs).sample(choices.shape).long().to(self.device)
-            # print(random_actions.is_cuda)
-            # print(choices.is_cuda)
             picked_actions = pick_random * random_actions + (1 - pick_random) * choices
             picked.append(torch.eye(num_choices)[picked_actions])
-            # print(num_choices)
 
-        picked_sigs = []
-        for c_id in range(self.args.n_peers):  # ([bs, max_msg_num, 2])*n_peers
-            num_choices = agent_inputs[-1][c_id].size(-1)  # 2
-            random_numbers = torch.rand_like(agent_inputs[-1][c_id][:, :, 0])
-            pick_random = (random_numbers < self.epsilon).long()
-            probs = torch.tensor([1 / num_choices] * num_choices)
-            choices = agent_inputs[-1][c_id].max(dim=2)[1]
-            random_actions = Categorical(probs).sample(choices.shape).long().to(self.device)
-            picked_actions = pick_random * random_actions + (1 - pick_random) * choices
-            picked_sigs.append(torch.eye(num_choices)[picked_actions])
-
-        picked_sigs = torch.cat(picked_sigs, dim=-1)
+        certificates = agent_inputs[-1]  # [bs, max_msg_num, n_peers, 2]
+        num_choices = certificates.size(-1)  # 2
+        random_numbers = torch.rand_like(certificates[:, :, :, 0])
+        pick_random = (random_numbers < self.epsilon).long()
+        probs = torch.tensor([1 / num_choices] * num_choices)
+        choices = certificates.max(dim=3)[1]
+        random_actions = Categorical(probs).sample(choices.shape).long().to(self.device)
+        picked_actions = pick_random * random_actions + (1 - pick_random) * choices
+        picked_sigs = torch.eye(num_choices)[picked_actions].flatten(start_dim=2)  # [bs, max_msg_num, n_peers * 2]
 
         picked.append(picked_sigs)
-        # print("picked action: {}".format([x.shape for x in picked]))
         picked = torch.cat(picked, dim=-1)
-        # print("action shape: {}".format(picked.shape))
         return picked.view(bs, -1)  # [bs, max_num_msg_per_round, msg_space]
 
 
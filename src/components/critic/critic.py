@@ -23,20 +23,28 @@ class Critic(nn.Module):
         inputs = self._build_inputs(batch, t)
         return self.rnn(inputs, hidden_states)
 
+    def forward_seq(self, batch, t_len, hidden_states=None):
+        # q values for timesteps [0, t_len) in one call, [bs, t_len, 2]
+        inputs = self._build_seq_inputs(batch, slice(0, t_len))
+        return self.rnn.forward_seq(inputs, hidden_states)
+
     def _build_inputs(self, batch, t):
+        return self._build_seq_inputs(batch, slice(t, t + 1)).squeeze(1)
+
+    def _build_seq_inputs(self, batch, ts):
         bs = batch.batch_size
         inputs = []
 
         # observation
-        inputs.append(batch["attacker_obs"][:, t])
-        inputs.append(batch["identifier_obs"][:, t])
+        inputs.append(batch["attacker_obs"][:, ts])
+        inputs.append(batch["identifier_obs"][:, ts])
 
         # actions
-        inputs.append(batch["attacker_action"][:, t])
-        inputs.append(batch["identifier_action"][:, t])
+        inputs.append(batch["attacker_action"][:, ts])
+        inputs.append(batch["identifier_action"][:, ts])
 
         # turn list inputs into tensor array
-        inputs = th.cat([x.reshape(bs, -1) for x in inputs], dim=-1)
+        inputs = th.cat([x.reshape(bs, x.size(1), -1) for x in inputs], dim=-1)
         return inputs
 
     def _get_input_shape(self, scheme):
@@ -1,14 +1,30 @@
+import math
+
 import torch as th
 
 from components.action_selectors import EpsilonGreedyAttackerActionSelector, EpsilonGreedyIdentifierActionSelector
 from module.agents.rnn_agent import RNNIdentifierAgent, RNNAttackerAgent
 
 
+@th.jit.script
+def epsilon_floor(probs, epsilon: float):
+    # mix with the uniform distribution over the last dim, scripted so the pointwise ops fuse into one kernel
+    return (1 - epsilon) * probs + epsilon / probs.size(-1)
+
+
+def log_epsilon_floor(log_probs, epsilon):
+    # epsilon_floor for log probabilities, log((1 - epsilon) * p + epsilon / n) without leaving log space
+    log_keep = math.log(1 - epsilon) if epsilon < 1 else -math.inf
+    log_uniform = math.log(epsilon / log_probs.size(-1)) if epsilon > 0 else -math.inf
+    return th.logaddexp(log_probs + log_keep, th.full_like(log_probs, log_uniform))
+
+
 class SeparateMAC:
     def __init__(self, scheme, groups, args):
         self.n_peers = args.n_peers
         self.args = args
         self.scheme = scheme
+        self.groups = groups
         self.attacker = None
         self.identifier = None
         self.attacker_hidden_states = None
@@ -31,40 +47,38 @@ class SeparateMAC:
         attacker_outs, self.attacker_hidden_states = self.attacker(attacker_input, self.attacker_hidden_states)
         identifier_outs, self.identifier_hidden_states = self.identifier(identifier_input, self.identifier_hidden_states)
 
-        # process the attacker
         if not test_mode:
-            # Epsilon floor for attacker
-            exploring_attacker_outs = []
-            for out in attacker_outs[:-1]:
-                epsilon_action_num = out.size(-1)
-                out = out.view(-1, epsilon_action_num)
-                exploring_out = ((1 - self.attacker_action_selector.epsilon) * out
-                                 + th.ones_like(out) * self.attacker_action_selector.epsilon/epsilon_action_num)
-                total_msgs_num = self.args.num_malicious*self.args.max_message_num_per_round
-                exploring_out = exploring_out.view(ep_batch.batch_size, total_msgs_num, -1)
-                exploring_attacker_outs.append(exploring_out)
-
-            cert_outs = []
-            for idx in range(self.n_peers):  # attacker_outs[-1]: ([bs, max_msg_num, 2])*n_peers
-                cert_out = attacker_outs[-1][idx]
-                epsilon_action_num = 2
-                cert_out = cert_out.view(-1, epsilon_action_num)
-                exploring_cert_out = ((1 - self.attacker_action_selector.epsilon) * cert_out
-                                 + th.ones_like(cert_out) * self.attacker_action_selector.epsilon / epsilon_action_num)
-                total_msgs_num = self.args.num_malicious * self.args.max_message_num_per_round
-                exploring_cert_out = exploring_cert_out.view(ep_batch.batch_size, total_msgs_num, -1)
-                cert_outs.append(exploring_cert_out)
-
-            exploring_attacker_outs.append(cert_outs)
-
-            # epsilon floor for identifier
-            epsilon_action_num = 2
-            exploring_identifier_outs = ((1 - self.identifier_action_selector.epsilon) * identifier_outs
-                                         + th.ones_like(identifier_outs) * self.identifier_action_selector.epsilon / epsilon_action_num)
-            return exploring_attacker_outs, exploring_identifier_outs
+            return self._exploring_outs(attacker_outs, identifier_outs)
         else:
             return attacker_outs, identifier_outs
 
+    def forward_seq(self, ep_batch, test_mode):
+        # all timesteps of ep_batch at once, outputs are laid out as in forward with an extra t dim after bs
+        # attacker outputs are log probabilities
+        attacker_input, identifier_input = self._build_seq_inputs(ep_batch)
+        attacker_outs, self.attacker_hidden_states = self.attacker.forward_seq(attacker_input,
+                                                                               self.attacker_hidden_states)
+        identifier_outs, self.identifier_hidden_states = self.identifier.forward_seq(identifier_input,
+                                                                                     self.identifier_hidden_states)
+
+        if not test_mode:
+            return self._exploring_outs(attacker_outs, identifier_outs, log_probs=True)
+        else:
+            return attacker_outs, identifier_outs
+
+    def _exploring_outs(self, attacker_outs, identifier_outs, log_probs=False):
+        # Epsilon floor for attacker
+        attacker_floor = log_epsilon_floor if log_probs else epsilon_floor
+        attacker_epsilon = self.attacker_action_selector.epsilon
+        # attacker_outs[-1]: [bs, max_msg_num, n_peers, 2], also a distribution over the last dim
+        exploring_attacker_outs = [attacker_floor(out, attacker_epsilon) for out in attacker_outs]
+
+        # epsilon floor for identifier, one bernoulli per peer rather than a distribution over the last dim
+        identifier_epsilon = self.identifier_action_selector.epsilon
+        epsilon_action_num = 2
+        exploring_identifier_outs = (1 - identifier_epsilon) * identifier_outs + identifier_epsilon / epsilon_action_num
+        return exploring_attacker_outs, exploring_identifier_outs
+
     def init_hidden(self, batch_size):
         self.attacker_hidden_states = self.attacker.init_hidden().expand(batch_size, -1)  # bav
         self.identifier_hidden_states = self.identifier.init_hidden().expand(batch_size, -1)
@@ -79,8 +93,16 @@ class SeparateMAC:
         return list(self.attacker.parameters()) + list(self.identifier.parameters())
 
     def load_state(self, other_mac):
-        self.attacker.load_state_dict(other_mac.attacker.state_dict())
-        self.identifier.load_state_dict(other_mac.identifier.state_dict())
+        # copy weights tensor by tensor, in place
+        with th.no_grad():
+            for param, other_param in zip(self.parameters(), other_mac.parameters()):
+                param.copy_(other_param)
+
+    def clone_for_target(self):
+        # same agents and weights, built from scheme/args instead of deep copying the whole mac
+        target_mac = SeparateMAC(self.scheme, self.groups, self.args)
+        target_mac.load_state(self)
+        return target_mac
 
     def cuda(self):
         self.attacker.cuda()
@@ -112,6 +134,11 @@ class SeparateMAC:
 
         return attacker_inputs, identifier_inputs
 
+    def _build_seq_inputs(self, batch):
+        attacker_inputs = batch["attacker_obs"]  # [bs, t, attacker_obs]
+        identifier_inputs = batch["identifier_obs"]
+        return attacker_inputs, identifier_inputs
+
     def _get_input_shape(self, scheme):
         attacker_input_shape = scheme["attacker_obs"]["vshape"]
         identifier_input_shape = scheme["identifier_obs"]["vshape"]
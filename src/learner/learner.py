@@ -1,5 +1,3 @@
-import copy
-
 from components.critic.critic import Critic
 from components.episode_buffer import EpisodeBatch
 import torch as th
@@ -33,9 +31,24 @@ class SeparateLearner:
         self.attacker_optimiser = Adam(params=self.attacker_params, lr=args.lr, eps=args.optim_eps)
         self.critic_optimiser = Adam(params=self.critic_params, lr=args.critic_lr, eps=args.optim_eps)
 
-        # a little wasteful to deepcopy (e.g. duplicates action selector), but should work for any MAC
-        self.target_mac = copy.deepcopy(mac)
+        # autocast and the scaler are pass-throughs unless use_amp is set and we are on cuda
+        self.use_amp = self.args.use_amp and self.device.type == "cuda"
+        self.scaler = th.cuda.amp.GradScaler(enabled=self.use_amp)
+
+        # the three optimisers own disjoint parameters, so on cuda each update runs on its own stream
+        use_streams = self.device.type == "cuda"
+        self.identifier_stream = th.cuda.Stream() if use_streams else None
+        self.attacker_stream = th.cuda.Stream() if use_streams else None
+        self.critic_stream = th.cuda.Stream() if use_streams else None
+
+        self.target_mac = mac.clone_for_target()
         self.target_critic = Critic(scheme, args)
+        # target networks are only ever copied into, never trained, so nothing run through them builds a graph
+        for param in self.target_mac.parameters():
+            param.requires_grad_(False)
+        self.target_critic.requires_grad_(False)
+        # (batch, td-lambda targets) of the last batch trained on, valid until the targets are updated
+        self._target_cache = None
 
         self.log_stats_t = -self.args.learner_log_interval - 1
 
@@ -47,126 +60,84 @@ class SeparateLearner:
         attacker_rewards = batch["attacker_reward"][:, :-1]
         identifier_actions = batch["identifier_action"][:, :-1]
         attacker_actions = batch["attacker_action"][:, :-1]
-        # print(attacker_actions)
         attacker_actions = self._parse_attacker_actions(attacker_actions)
-        # print("done with action parsing")
-        # print(attacker_actions)
         terminated = batch["terminated"][:, :-1].float()
         mask = batch["filled"][:, :-1].float()  # [bs, t-1, 1]
         mask[:, 1:] = mask[:, 1:] * (1 - terminated[:, :-1])
 
-        critic_mask = mask.clone().repeat(1, 1, self.n_agents)
+        critic_mask = mask.expand(-1, -1, self.n_agents)  # read-only broadcasts from here on
 
         rewards = (attacker_rewards, identifier_rewards)
-        q_vals, critic_train_stats = self._train_critic(batch, rewards, terminated, critic_mask)  # [bs, t, 2]
-        # print("done with critic")
+        q_vals, critic_loss, critic_train_stats = self._critic_loss(batch, rewards, terminated, critic_mask)  # [bs, t, 2]
+        q_vals = q_vals.detach()  # critic_loss keeps its own graph, the actors only weight by q_vals
 
         # Calculate estimated Q-Values
-        attacker_outs = []
-        identifier_outs = []
         self.mac.init_hidden(bs)
-        for t in range(batch.max_seq_length):
-            attacker_out, identifier_out = self.mac.forward(batch, t=t, test_mode=False)  # (bs,n,n_actions)
-            attacker_outs.append(attacker_out)  # [t,(bs,n_peers)]
-            identifier_outs.append(identifier_out)
+        with th.cuda.amp.autocast(enabled=self.use_amp):
+            attacker_outs, identifier_outs = self.mac.forward_seq(batch, test_mode=False)  # (bs,t,n,n_actions)
 
         # learn identifier actor
-        identifier_outs = th.stack(identifier_outs, dim=1).unsqueeze(-1)  # Concat over time
-        # print("identifier_outs_shape: {}".format(identifier_outs.shape))
-        # print("identifier_outs: {}".format(identifier_outs))
+        identifier_outs = identifier_outs.float().unsqueeze(-1)  # [bs, t, n_peers, 1]
         identifier_outs = th.cat([identifier_outs, 1 - identifier_outs], dim=-1).reshape(bs, b_len, self.n_peers, 2)
-        identifier_outs = F.softmax(identifier_outs, dim=-1)  # TODO: This is bad
-        # print("identifier_outs_shape: {}".format(identifier_outs.shape))
-        # print("stacked_identifier_outs: {}".format(identifier_outs[0][0]))
+        log_identifier_outs = F.log_softmax(identifier_outs, dim=-1)  # TODO: This is bad
         # (bs,t,n,n_actions), Q values of n_actions
 
         # Pick the Q-Values for the actions taken by each agent
-        # print(identifier_actions)
         identifier_actions = identifier_actions.unsqueeze(3).type(th.int64)
-        # print("identifier_actions_shape: {}".format(identifier_actions.shape))
-        # print("identifier_actions: {}".format(identifier_actions[0][0]))
-        identifier_chosen_action_pi = th.gather(identifier_outs[:, :-1], dim=3, index=identifier_actions).squeeze(
-            3)  # Remove the last dim
-        # print("identifier_chosen_action_pi: {}".format(identifier_chosen_action_pi[0][0]))
-        identifier_mask = mask.clone().repeat(1, 1, self.n_peers)
-        # print("identifier_mask: {}".format(identifier_mask[0][0]))
-        identifier_chosen_action_pi[identifier_mask == 0] = 1.0
-        # print("identifier_chosen_action_pi after mask: {}".format(identifier_chosen_action_pi[0][1]))
-        log_identifier_pi = th.log(identifier_chosen_action_pi).sum(dim=-1)
-        # print("log_identifier_pi: {}".format(log_identifier_pi[0][0]))
-
-        identifier_critic = mask.clone().reshape(-1)
-        identifier_loss = ((q_vals[:, :, 1].reshape(-1).detach() * log_identifier_pi.reshape(
+        log_identifier_chosen_action_pi = th.gather(log_identifier_outs[:, :-1], dim=3,
+                                                    index=identifier_actions).squeeze(3)  # Remove the last dim
+        identifier_mask = mask.expand(-1, -1, self.n_peers)
+        log_identifier_chosen_action_pi = log_identifier_chosen_action_pi.masked_fill(identifier_mask == 0, 0.0)
+        log_identifier_pi = log_identifier_chosen_action_pi.sum(dim=-1)
+
+        identifier_critic = mask.reshape(-1)
+        identifier_loss = ((q_vals[:, :, 1].reshape(-1) * log_identifier_pi.reshape(
             -1)) * identifier_critic).sum() / identifier_critic.sum()
-        # print("q_vals 001: {}".format(q_vals[0][0][1]))
-        # print("log_identifier_pi: {}".format(log_identifier_pi[0][0]))
-        # print("q_vals * log_identifier_pi: {}".format((q_vals[:, :, 1].reshape(-1) * log_identifier_pi.reshape(-1))[0]))
-        # print("q_vals 011: {}".format(q_vals[0][1][1]))
-        # print("log_identifier_pi: {}".format(log_identifier_pi[0][1]))
-        # print("q_vals * log_identifier_pi: {}".format((q_vals[:, :, 1].reshape(-1) * log_identifier_pi.reshape(-1))[1]))
-        # print(q_vals[:, :, 1].reshape(-1) * log_identifier_pi.reshape(-1))
-        # print("mask shape: {}".format(mask.shape))
-        self.identifier_optimiser.zero_grad()
-        identifier_loss.backward()
-        identifier_grad_norm = th.nn.utils.clip_grad_norm_(self.identifier_params, self.args.grad_norm_clip)
-        self.identifier_optimiser.step()
-        # print("done with identifier")
-        num_action_types = len(attacker_outs[0])
+
+        # learn attacker actor
+        num_action_types = len(attacker_outs)
         total_msgs_num = self.args.num_malicious * self.args.max_message_num_per_round
-        attacker_mask = mask.clone().repeat(1, 1, total_msgs_num)
-        pi = []
+        attacker_mask = mask.expand(-1, -1, total_msgs_num)
+        log_pi = []
         for idx in range(num_action_types - 1):
-            out = th.stack([attacker_outs[t][idx] for t in range(len(attacker_outs))],
-                           dim=1)  # [bs, t, max_msg, num_action]
-            # print(out.shape)
-            # print(attacker_actions[idx])
-            # print(out.is_cuda)
-            # print(attacker_actions[idx].is_cuda)
+            out = attacker_outs[idx].float()  # [bs, t, max_msg, num_action], log probabilities
             attacker_action = attacker_actions[idx]
             out = th.gather(out[:, :-1], dim=3, index=attacker_action).squeeze(3)
-            # print("attacker out shape: {}".format(out.shape))
-            out[attacker_mask == 0] = 1.0
-            pi.append(out)
-        pi = th.cat(pi, dim=-1)
-
-        cert_pi = []
-        for r_id in range(self.n_peers):  # ([bs, max_msg_num, 2])*n_peers
-            out = th.stack([attacker_outs[t][-1][r_id] for t in range(len(attacker_outs))],
-                           dim=1)  # [bs, t, max_msg, 2]
-            attacker_action = attacker_actions[-1][r_id]
-            out = th.gather(out[:, :-1], dim=3, index=attacker_action).squeeze(3)
-            # print("attacker out shape: {}".format(out.shape))
-            out[attacker_mask == 0] = 1.0
-            cert_pi.append(out)
-        cert_pi = th.cat(cert_pi, dim=-1)
-        pi = th.cat([pi, cert_pi], dim=-1)
-        log_attacker_pi = th.log(pi).sum(-1)
-        # print("q_vals: {}".format(q_vals.shape))
-        # print("log_attacker_pi: {}".format(log_attacker_pi.shape))
-        # print("q_vals * log_identifier_pi: {}".format((q_vals[:, :, 1].reshape(-1) * log_identifier_pi.reshape(-1))[1]))
-
-        attacker_critic = mask.clone().reshape(-1)
-        attacker_loss = ((q_vals[:, :, 0].reshape(-1).detach() * log_attacker_pi.reshape(
+            log_pi.append(out.masked_fill(attacker_mask == 0, 0.0))
+        log_pi = th.cat(log_pi, dim=-1)
+
+        cert_out = attacker_outs[-1].float()  # [bs, t, max_msg, n_peers, 2]
+        cert_log_pi = th.gather(cert_out[:, :-1], dim=4, index=attacker_actions[-1]).squeeze(4)
+        cert_log_pi = cert_log_pi.masked_fill(attacker_mask.unsqueeze(-1) == 0, 0.0).flatten(start_dim=2)
+        log_attacker_pi = th.cat([log_pi, cert_log_pi], dim=-1).sum(-1)
+
+        attacker_critic = mask.reshape(-1)
+        attacker_loss = ((q_vals[:, :, 0].reshape(-1) * log_attacker_pi.reshape(
             -1)) * attacker_critic).sum() / attacker_critic.sum()
-        self.attacker_optimiser.zero_grad()
-        attacker_loss.backward()
-        attacker_grad_norm = th.nn.utils.clip_grad_norm_(self.attacker_params, self.args.grad_norm_clip)
-        self.attacker_optimiser.step()
-        # print("done with attacker")
+
+        # the critic, identifier and attacker share no modules and the actors only see detached q_vals,
+        # so a single backward over the summed losses gives each network exactly the gradients of its own loss
+        for optimiser in [self.critic_optimiser, self.identifier_optimiser, self.attacker_optimiser]:
+            optimiser.zero_grad(set_to_none=True)  # drop the grads instead of zero-filling them
+        self.scaler.scale(critic_loss + identifier_loss + attacker_loss).backward()
+
+        critic_grad_norm = self._step(self.critic_optimiser, self.critic_params, self.critic_stream)
+        identifier_grad_norm = self._step(self.identifier_optimiser, self.identifier_params, self.identifier_stream)
+        attacker_grad_norm = self._step(self.attacker_optimiser, self.attacker_params, self.attacker_stream)
+        for stream in [self.critic_stream, self.identifier_stream, self.attacker_stream]:
+            if stream is not None:
+                th.cuda.current_stream().wait_stream(stream)
+        self.scaler.update()
+        self.critic_training_steps += 1
+        critic_train_stats["critic_grad_norm"] = critic_grad_norm
 
         if (self.critic_training_steps - self.last_target_update_step) / self.args.target_update_interval >= 1.0:
             self._update_targets()
             self.last_target_update_step = self.critic_training_steps
 
-        # print("identifier_actor_loss： {}".format(identifier_loss.item()))
-        # print("identifier_grad_norm: {}".format(identifier_grad_norm.item()))
-        # print("attacker_actor_loss: {}".format(attacker_loss.item()))
-        # print("attacker_grad_norm: {}".format(attacker_grad_norm.item()))
-
         if t_env - self.log_stats_t >= self.args.learner_log_interval:
-            ts_logged = len(critic_train_stats["critic_loss"])
             for key in ["critic_loss", "critic_grad_norm", "td_error_abs", "q_taken_mean", "target_mean"]:
-                self.logger.log_stat(key, sum(critic_train_stats[key]) / ts_logged, t_env)
+                self.logger.log_stat(key, critic_train_stats[key].item(), t_env)
 
             self.logger.log_stat("identifier_actor_loss", identifier_loss.item(), t_env)
             self.logger.log_stat("identifier_grad_norm", identifier_grad_norm.item(), t_env)
@@ -174,142 +145,82 @@ class SeparateLearner:
             self.logger.log_stat("attacker_grad_norm", attacker_grad_norm.item(), t_env)
             self.log_stats_t = t_env
 
-    def _train_critic(self, batch, rewards, terminated, mask):
-        # Optimise critic
+    def _critic_loss(self, batch, rewards, terminated, mask):
         rewards = th.cat(rewards, dim=-1).detach()  # [bs, t, 2]
 
-        target_critic_outs = []
-        target_critic_hidden = self.target_critic.init_hidden().expand(batch.batch_size, -1)
-        for t in range(batch.max_seq_length):
-            out, target_critic_hidden = self.target_critic.forward(batch, target_critic_hidden, t)  # (bs, 2)
-            target_critic_outs.append(out)  # [t,(bs, 2)]
-        target_critic_outs = th.stack(target_critic_outs, dim=1)  # [bs, t, 2]
+        if self._target_cache is not None and self._target_cache[0] is batch:
+            targets = self._target_cache[1]
+        else:
+            targets = self._td_lambda_targets(batch, rewards, terminated, mask)
+            # hold on to the batch itself, an id() key could be reused by the next sample
+            self._target_cache = (batch, targets)
 
-        # Calculate td-lambda targets
-        targets = build_td_lambda_targets(rewards, terminated, mask, target_critic_outs, self.n_agents, self.args.gamma,
-                                          self.args.td_lambda).detach()
-        # print("target shape： {}".format(targets.shape))
-
-        q_vals = th.zeros_like(target_critic_outs)[:, :-1]  # [bs, t-1, 2]
-        critic_hidden = self.critic.init_hidden().expand(batch.batch_size, -1)
-        for t in reversed(range(rewards.size(1))):
-            q_t, critic_hidden = self.critic(batch, critic_hidden, t)
-            q_vals[:, t] = q_t
+        with th.cuda.amp.autocast(enabled=self.use_amp):
+            q_vals, _ = self.critic.forward_seq(batch, rewards.size(1))  # [bs, t-1, 2]
+        q_vals = q_vals.float()
 
         td_error = (q_vals - targets)
-        mask_t = mask.clone().expand(-1, -1, self.n_agents)
+        mask_t = mask  # [bs, t-1, n_agents]
         # 0-out the targets that came from padded data
         masked_td_error = td_error * mask_t
 
         # Normal L2 loss, take mean over actual data
-        loss = (masked_td_error ** 2).sum() / mask_t.sum()
-        self.critic_optimiser.zero_grad()
-        loss.backward()
-
-        grad_norm = th.nn.utils.clip_grad_norm_(self.critic_params, self.args.grad_norm_clip)
-        self.critic_optimiser.step()
-        self.critic_training_steps += 1
+        mask_elems = mask_t.sum()
+        loss = (masked_td_error ** 2).sum() / mask_elems
 
+        # kept as tensors so nothing syncs with the device before the updates are queued
         running_log = {
-            "critic_loss": [],
-            "critic_grad_norm": [],
-            "td_error_abs": [],
-            "target_mean": [],
-            "q_taken_mean": [],
+            "critic_loss": loss.detach(),
+            "td_error_abs": masked_td_error.detach().abs().sum() / mask_elems,
+            "q_taken_mean": (q_vals.detach() * mask_t).sum() / mask_elems,
+            "target_mean": (targets * mask_t).sum() / mask_elems,
         }
 
-        running_log["critic_loss"].append(loss.item())
-        running_log["critic_grad_norm"].append(grad_norm.item())
-        mask_elems = mask_t.sum().item()
-        running_log["td_error_abs"].append((masked_td_error.abs().sum().item() / mask_elems))
-        running_log["q_taken_mean"].append((q_vals.reshape(-1) * mask_t.reshape(-1)).sum().item() / mask_elems)
-        running_log["target_mean"].append((targets.reshape(-1) * mask_t.reshape(-1)).sum().item() / mask_elems)
+        return q_vals, loss, running_log
 
-        return q_vals, running_log
+    def _td_lambda_targets(self, batch, rewards, terminated, mask):
+        # inference only, no graph is needed
+        with th.no_grad(), th.cuda.amp.autocast(enabled=self.use_amp):
+            target_critic_outs, _ = self.target_critic.forward_seq(batch, batch.max_seq_length)
+        target_critic_outs = target_critic_outs.float()  # [bs, t, 2]
+
+        # Calculate td-lambda targets
+        return build_td_lambda_targets(rewards, terminated, mask, target_critic_outs, self.n_agents, self.args.gamma,
+                                       self.args.td_lambda).detach()
+
+    def _step(self, optimiser, params, stream):
+        # unscale before clipping, the scaler is updated once per train call
+        if stream is not None:
+            stream.wait_stream(th.cuda.current_stream())
+        with th.cuda.stream(stream):  # no-op for None
+            self.scaler.unscale_(optimiser)
+            grad_norm = th.nn.utils.clip_grad_norm_(params, self.args.grad_norm_clip)
+            self.scaler.step(optimiser)
+        return grad_norm
 
     def _parse_attacker_actions(self, actions):
-        # actions: [bs, t, num_max_msgs * ]
+        # actions: [bs, t, num_max_msgs * msg_action_space], one-hot fields of each message concatenated
         bs = actions.size(0)
         t_len = actions.size(1)
         total_msgs_num = self.args.num_malicious * self.args.max_message_num_per_round
-        # print("actions_shape: {}".format(actions.shape))
+        num_msg_type = 10  # no client type, 9 is no-op
         actions = actions.reshape(bs, t_len, total_msgs_num, -1)
-        parsed_actions = []
-        for bs_idx in range(bs):
-            parsed_actions_t = []
-            for t_idx in range(t_len):
-                parsed_actions_t_msg = []
-                for msg_idx in range(total_msgs_num):
-                    parsed_actions_t_msg.append(self._parse_input_message(actions[bs_idx][t_idx][msg_idx]).unsqueeze(0))
-                parsed_actions_t.append(th.cat(parsed_actions_t_msg, dim=0).unsqueeze(0))
-            parsed_actions.append(th.cat(parsed_actions_t, dim=0).unsqueeze(0))
-
-        parsed_actions = th.cat(parsed_actions, dim=0)
-        ret = list(th.split(parsed_actions, [1,
-                                             1,
-                                             1,
-                                             1,
-                                             1,
-                                             1,
-                                             4], dim=-1))
-        ret_cert = list(ret[-1].split(1, dim=-1))
-        ret = list(ret[:-1])
+        fields = actions.split([num_msg_type,
+                                self.args.num_malicious,
+                                self.args.max_view_num,
+                                self.args.max_seq_num,
+                                self.args.total_client_vals,
+                                self.args.n_peers,
+                                self.args.n_peers * 2], dim=-1)
+        ret = [rev_onehot(x) for x in fields[:-1]]  # [bs, t, total_msgs_num, 1] each
+        ret_cert = list_rev_onehot(fields[-1]).unsqueeze(-1)  # [bs, t, total_msgs_num, n_peers, 1]
         ret.append(ret_cert)
         return ret
 
-    def _parse_input_message(self, msg_input):
-        num_msg_type = 10  # no client type, 9 is no-op
-        # msg_action_space = num_msg_type + self.args.num_malicious + \
-        #                    self.args.episode_limit / 4 + self.args.episode_limit / 4 + \
-        #                    len(client_vals) + self.args.n_peers + self.args.n_peers
-
-        msg = []
-        idx = 0
-
-        msg_type_input = msg_input[idx: num_msg_type]
-        msg.append(rev_onehot(msg_type_input))
-        # print("msg input shape: {}".format(msg_input.shape))
-        # print("msg type: {}".format(msg_type_input))
-        # print("msg type: {}".format(rev_onehot(msg_type_input)))
-
-        idx = num_msg_type
-        sender_id_input = msg_input[idx: idx + self.args.num_malicious]
-
-        msg.append(rev_onehot(sender_id_input))
-        # print("sender id shape: {}".format(sender_id_input.shape))
-        # print("sender id: {}".format(sender_id_input))
-        # print("sender id: {}".format(rev_onehot(sender_id_input)))
-
-        idx += self.args.num_malicious
-        view_num_input = msg_input[idx: idx + self.args.max_view_num]
-        msg.append(rev_onehot(view_num_input))
-
-        idx += self.args.max_view_num
-        seq_num_input = msg_input[idx: idx + self.args.max_seq_num]
-        msg.append(rev_onehot(seq_num_input))
-
-        idx += self.args.max_seq_num
-        val_input = msg_input[idx: idx + self.args.total_client_vals]
-        msg.append(rev_onehot(val_input))
-
-        idx += self.args.total_client_vals
-        receiver_id_input = msg_input[idx: idx + self.args.n_peers]
-        msg.append(rev_onehot(receiver_id_input))
-
-        idx += self.args.n_peers
-        certificate_input = msg_input[idx:]
-        msg.append(list_rev_onehot(certificate_input))
-        # print("certificate shape: {}".format(certificate_input.shape))
-        # print("c id: {}".format(certificate_input))
-        # print("c id: {}".format(list_rev_onehot(certificate_input)))
-        # print("msg: {}".format(msg))
-        msg = th.cat(msg, dim=-1)
-
-        return msg
-
     def _update_targets(self):
         self.target_mac.load_state(self.mac)
         self.target_critic.load_state_dict(self.critic.state_dict())
+        self._target_cache = None
         self.logger.console_logger.info("Updated target network")
 
     def cuda(self):
@@ -333,6 +244,7 @@ class SeparateLearner:
         self.critic.load_state_dict(th.load("{}/critic.th".format(path), map_location=lambda storage, loc: storage))
         self.target_critic.load_state_dict(
             th.load("{}/tar_critic.th".format(path), map_location=lambda storage, loc: storage))
+        self._target_cache = None
         self.identifier_optimiser.load_state_dict(
             th.load("{}/identifier_opt.th".format(path), map_location=lambda storage, loc: storage))
         self.attacker_optimiser.load_state_dict(
@@ -341,10 +253,9 @@ class SeparateLearner:
             th.load("{}/critic_opt.th".format(path), map_location=lambda storage, loc: storage))
 
 
-def list_rev_onehot(x):  # for certificates
-    return x.reshape(-1, 2).argmax(dim=-1)
+def list_rev_onehot(x):  # for certificates, [..., n_peers * 2] -> [..., n_peers]
+    return x.reshape(*x.shape[:-1], -1, 2).argmax(dim=-1)
 
 
-def rev_onehot(x):  # anyvalue if invalid, will be masked out
-    # print(x)
-    return x.argmax().unsqueeze(0)
+def rev_onehot(x):  # anyvalue if invalid, will be masked out, [..., n] -> [..., 1]
+    return x.argmax(dim=-1, keepdim=True)
@@ -1,3 +1,4 @@
+import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -24,8 +25,19 @@ class RNNAgent(nn.Module):
         # h = F.relu(self.fc3(h))
         q = self.fc2(h)
         q = self.fc3(q)
-        # print("q shape: {}".format(q.shape))
-        # print("h shape: {}".format(h.shape))
+        return q, h
+
+    def forward_seq(self, inputs, hidden_state=None):
+        # inputs: [bs, t, input_shape], only the recurrent cell is stepped per timestep
+        # without a hidden_state the cell starts from zeros, same as init_hidden
+        x = self.fc1(inputs)
+        h = None if hidden_state is None else hidden_state.reshape(-1, self.args.rnn_hidden_dim)
+        hs = []
+        for t in range(x.size(1)):
+            h = self.rnn(x[:, t], h)
+            hs.append(h)
+        q = self.fc2(th.stack(hs, dim=1))  # [bs, t, rnn_hidden_dim]
+        q = self.fc3(q)
         return q, h
 
 
@@ -43,6 +55,11 @@ class RNNIdentifierAgent(nn.Module):
         x = F.normalize(x, dim=-1)  # normalize to range [0, 1]
         return x, h
 
+    def forward_seq(self, inputs, hidden_state):
+        x, h = self.rnn.forward_seq(inputs, hidden_state)
+        x = F.normalize(x, dim=-1)  # normalize to range [0, 1]
+        return x, h
+
 
 class RNNAttackerAgent(nn.Module):
     def __init__(self, input_shape, output_shape, args):
@@ -55,32 +72,29 @@ class RNNAttackerAgent(nn.Module):
         return self.rnn.init_hidden()
 
     def forward(self, inputs, hidden_state):
-        # print("inputs shape: {}".format(inputs.shape))
         x, h = self.rnn(inputs, hidden_state)
-        # time to dissemble x
+        x = tuple(F.softmax(out, dim=-1) for out in self._dissemble(x))
+        return x, h
+
+    def forward_seq(self, inputs, hidden_state):
+        # log probabilities instead, only log pi of the taken actions is needed for training
+        x, h = self.rnn.forward_seq(inputs, hidden_state)
+        x = tuple(F.log_softmax(out, dim=-1) for out in self._dissemble(x))
+        return x, h
+
+    def _dissemble(self, x):
+        # [..., msg_action_space * max_msg_num] -> logits per action type [..., max_msg_num, num_action]
         num_msg_type = 10
-        x = x.reshape(-1, self.args.max_message_num_per_round*self.args.num_malicious, self.msg_action_shape)  # split
+        x = x.reshape(*x.shape[:-1], self.args.max_message_num_per_round*self.args.num_malicious, self.msg_action_shape)  # split
         msg_types, signer_ids, view_nums, seq_nums, vals, receiver_ids, certificates = x.split([num_msg_type,
                                                                                                 self.args.num_malicious,
                                                                                                 self.args.max_view_num,
                                                                                                 self.args.max_seq_num,
                                                                                                 self.args.total_client_vals,
                                                                                                 self.args.n_peers,
-                                                                                                self.args.n_peers*2], dim=2)
-        certificates = list(certificates.split(2, dim=-1))  # make tuple iterable ([bs, max_msg_num, 2])*n_peers
-        msg_types = F.softmax(msg_types, dim=-1)
-        signer_ids = F.softmax(signer_ids, dim=-1)
-        view_nums = F.softmax(view_nums, dim=-1)
-        seq_nums = F.softmax(seq_nums, dim=-1)
-        vals = F.softmax(vals, dim=-1)
-        # print("vals shape: {}, vals: {}".format(vals.shape, vals))
-        receiver_ids = F.softmax(receiver_ids, dim=-1)
-        for idx in range(len(certificates)):
-            # print("sig shape: {}".format(certificates[idx].shape))
-            # print("sig in certificate: {}".format(certificates[idx]))
-            certificates[idx] = F.softmax(certificates[idx], dim=-1)
-        x = (msg_types, signer_ids, view_nums, seq_nums, vals, receiver_ids, certificates)
-        return x, h
+                                                                                                self.args.n_peers*2], dim=-1)
+        certificates = certificates.reshape(*certificates.shape[:-1], self.args.n_peers, 2)  # [bs, max_msg_num, n_peers, 2]
+        return msg_types, signer_ids, view_nums, seq_nums, vals, receiver_ids, certificates
 
     def _get_msg_shape(self):  # TODO: move this to env_info[]
         num_msg_type = 10  # no client type, 9 is no-op